@@ -5,8 +5,19 @@ from update import (
     path_directory,
     path_save,
     download_table,
+    insert_rows,
+    dedupe_key,
+    read_bulk_file,
+    get_date_start,
+    parse_args,
+    has_weekday,
 )
 import datetime
+import sqlite3
+
+import pandas as pd
+
+import update
 
 # Class for including args.
 class ArgsTest:
@@ -108,4 +119,118 @@ def test_db_exist():
     pass
 
 def test_return_yesterday():
-    pass
\ No newline at end of file
+    pass
+
+def test_insert_rows():
+    conn = sqlite3.connect(":memory:")
+    df = pd.DataFrame(
+        {
+            "ticker": ["AAPL", "MSFT"],
+            "date": pd.to_datetime(["2020-04-01", "2020-04-02"]),
+            "close": [240.91, float("nan")],
+        }
+    )
+    insert_rows(conn, "SEP", df)
+    insert_rows(conn, "SEP", df)
+
+    rows = conn.execute("SELECT ticker, date, close FROM SEP").fetchall()
+    assert len(rows) == 4
+    assert rows[0] == ("AAPL", "2020-04-01 00:00:00", 240.91)
+    assert rows[1][2] is None
+
+
+def test_insert_rows_key():
+    conn = sqlite3.connect(":memory:")
+    df = pd.DataFrame(
+        {"ticker": ["AAPL", "MSFT"], "date": ["2020-04-01", "2020-04-01"], "close": [1.0, 2.0]}
+    )
+    insert_rows(conn, "SEP", df, key=("ticker", "date"))
+    insert_rows(conn, "SEP", df.assign(close=[3.0, 4.0]), key=("ticker", "date"))
+
+    rows = conn.execute("SELECT ticker, close FROM SEP ORDER BY ticker").fetchall()
+    assert rows == [("AAPL", 3.0), ("MSFT", 4.0)]
+
+
+def test_insert_rows_missing_key():
+    conn = sqlite3.connect(":memory:")
+    df = pd.DataFrame({"ticker": ["AAPL", "MSFT"], "lastupdated": ["2020-04-01"] * 2})
+    insert_rows(conn, "DAILY", df, key=("ticker", "date"))
+
+    assert conn.execute("SELECT COUNT(*) FROM DAILY").fetchone()[0] == 2
+
+
+def test_has_weekday():
+    assert not has_weekday("2020-04-04", "2020-04-05")
+    assert has_weekday("2020-04-04", "2020-04-06")
+    assert has_weekday("2020-04-03", "2020-04-03")
+    assert not has_weekday("2020-04-07", "2020-04-06")
+
+
+def test_dedupe_key():
+    conn = sqlite3.connect(":memory:")
+    df = pd.DataFrame(
+        {"ticker": ["AAPL", "AAPL", "MSFT"], "date": ["2020-04-01"] * 3, "close": [1.0, 2.0, 3.0]}
+    )
+    insert_rows(conn, "SEP", df)
+    dedupe_key(conn, "SEP")
+    insert_rows(conn, "SEP", df.tail(1).assign(close=4.0), key=("ticker", "date"))
+
+    rows = conn.execute("SELECT ticker, close FROM SEP ORDER BY ticker").fetchall()
+    assert rows == [("AAPL", 2.0), ("MSFT", 4.0)]
+
+
+def test_bulk_then_api_upsert(tmp_path):
+    path = tmp_path / "DAILY.zip"
+    bulk = pd.DataFrame(
+        {"ticker": ["AAPL"], "date": ["2020-04-01"], "lastupdated": ["2020-04-02"], "ev": [1.0]}
+    )
+    bulk.to_csv(path, index=False, compression={"method": "zip", "archive_name": "DAILY.csv"})
+
+    conn = sqlite3.connect(":memory:")
+    for df in read_bulk_file(path, "DAILY"):
+        insert_rows(conn, "DAILY", df)
+    dedupe_key(conn, "DAILY")
+    api = bulk.assign(
+        date=pd.to_datetime(["2020-04-01"]), lastupdated=pd.to_datetime(["2020-04-03"]), ev=2.0
+    )
+    insert_rows(conn, "DAILY", api, key=("ticker", "date"))
+
+    rows = conn.execute("SELECT date, lastupdated, ev FROM DAILY").fetchall()
+    assert rows == [("2020-04-01 00:00:00", "2020-04-03 00:00:00", 2.0)]
+
+
+def test_get_date_start_dedupes_old_table(monkeypatch):
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE _meta(table_name TEXT PRIMARY KEY, max_date TEXT)")
+    df = pd.DataFrame({"ticker": ["AAPL", "AAPL"], "date": ["2020-04-01 00:00:00"] * 2})
+    insert_rows(conn, "SEP", df)
+    monkeypatch.setattr(update, "get_conn", lambda args: conn)
+    args = parse_args([])
+
+    assert get_date_start(conn, "SEP", args, "2020-04-10") == "2020-04-02"
+    assert conn.execute("SELECT COUNT(*) FROM SEP").fetchone()[0] == 1
+    insert_rows(conn, "SEP", df.head(1), key=("ticker", "date"))
+    assert conn.execute("SELECT COUNT(*) FROM SEP").fetchone()[0] == 1
+
+
+def test_get_date_start_bulk_empty_table(monkeypatch):
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE _meta(table_name TEXT PRIMARY KEY, max_date TEXT)")
+    pd.DataFrame({"ticker": [], "date": []}).to_sql("SEP", conn, index=False)
+    monkeypatch.setattr(update, "get_conn", lambda args: conn)
+    args = parse_args([])
+
+    assert get_date_start(conn, "SEP", args, "2020-04-10", bulk=True) is None
+    assert get_date_start(conn, "SEP", args, "2020-04-10") == "2020-04-03"
+
+
+def test_save_chunks_bounded(monkeypatch):
+    started = []
+    monkeypatch.setattr(update, "save_chunk", lambda t, a, s, e, tc: started.append(tc) or len(tc))
+    ticker_chunks = [(str(i),) * (i + 1) for i in range(10)]
+
+    for taken, (tc, rows) in enumerate(update.save_chunks("SEP", None, "", "", ticker_chunks)):
+        assert tc == ticker_chunks[taken]
+        assert rows == taken + 1
+        assert len(started) <= taken + update.chunk_workers
+    assert len(started) == 10
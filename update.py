@@ -14,13 +14,22 @@
 #
 ###############################################################################
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import datetime
+import functools
+import os
 from pathlib import Path
 import sqlite3
+import tempfile
+import threading
 import time
+import zipfile
+from typing import NamedTuple, Optional, Tuple
 
-import pandas as pd
-import quandl
+import requests
+from requests.adapters import HTTPAdapter
 
 from config import apikey
 
@@ -28,19 +37,98 @@ from config import apikey
 For downloading zip files. 
 https://www.quandl.com/tables/SHARADAR-SF1/export?api_key=insert_key
 """
-sharadar_tables = {
-    "TICKERS": ["lastupdated", "Tickers and Metadata", 1],
-    "EVENTS": ["date", "Core US Fundamental Events", 1],
-    "SF3A": ["calendardate", "Core US Institutional Investors Summary by Ticker", 1],
-    "SF3B": ["calendardate", "Core US Institutional Investors Summary by Investor", 1],
-    "ACTIONS": ["date", "Corporate Actions", 1],
-    "SP500": ["date", "S&P500 Current and Historical Constituents", 1],
-    "SFP": ["date", "Sharadar Fund Prices", 5],
-    "SF1": ["lastupdated", "Core US Fndamentals", 7],
-    "DAILY": ["lastupdated", "Daily Metrics", 9],
-    "SEP": ["date", "Sharadar Equity Prices", 11],
-    "SF2": ["filingdate", "Core US Insiders", 17],
-    "SF3": ["calendardate", "Core US Institutional Investors Summary by Ticker", 21],
+bulk_url = "https://www.quandl.com/api/v3/datatables/SHARADAR/{}.json"
+
+# One keep-alive session shared by every request to Quandl.
+session = requests.Session()
+
+# Seconds to wait on a stalled connection to Quandl before giving up.
+http_timeout = 60
+
+# Database connections, one per thread as sqlite3 connections can't be used from two threads at once.
+local_conns = threading.local()
+open_conns = []
+open_conns_lock = threading.Lock()
+
+# Taken around every write transaction. SQLite allows one writer at a time, and a bulk load can
+# hold its lock for longer than the busy timeout, so writers queue here instead.
+db_write_lock = threading.Lock()
+
+# Chunks of the tickers in each database, built once and shared by every table downloaded by ticker.
+ticker_chunks_cache = {}
+ticker_chunks_lock = threading.Lock()
+
+# Caps the requests in flight to Quandl across all workers, to stay clear of its rate limit.
+quandl_slots = threading.BoundedSemaphore(5)
+
+# Ticker chunks of one table fetched at the same time. Requests still queue on quandl_slots.
+chunk_workers = 4
+
+
+class TableInfo(NamedTuple):
+    """Details of one Sharadar table, with the fields typed and named rather than indexed."""
+
+    date_col: str
+    desc: str
+    size: int
+    key: Optional[Tuple[str, ...]]
+
+
+# The key holds the columns that identify a row, used to update rows that are downloaded again.
+# Tables without a reliable key are only ever appended to.
+_raw_tables = {
+    "TICKERS": ["lastupdated", "Tickers and Metadata", 1, ("table", "permaticker")],
+    "EVENTS": ["date", "Core US Fundamental Events", 1, ("ticker", "date")],
+    "SF3A": [
+        "calendardate",
+        "Core US Institutional Investors Summary by Ticker",
+        1,
+        ("ticker", "calendardate"),
+    ],
+    "SF3B": [
+        "calendardate",
+        "Core US Institutional Investors Summary by Investor",
+        1,
+        ("investorname", "calendardate"),
+    ],
+    "ACTIONS": ["date", "Corporate Actions", 1, None],
+    "SP500": ["date", "S&P500 Current and Historical Constituents", 1, None],
+    "SFP": ["date", "Sharadar Fund Prices", 5, ("ticker", "date")],
+    "SF1": [
+        "lastupdated",
+        "Core US Fndamentals",
+        7,
+        ("ticker", "dimension", "calendardate", "datekey"),
+    ],
+    "DAILY": ["lastupdated", "Daily Metrics", 9, ("ticker", "date")],
+    "SEP": ["date", "Sharadar Equity Prices", 11, ("ticker", "date")],
+    "SF2": ["filingdate", "Core US Insiders", 17, None],
+    "SF3": ["calendardate", "Core US Institutional Investors Summary by Ticker", 21, None],
+}
+sharadar_tables = {k: TableInfo(*v) for k, v in _raw_tables.items()}
+
+# Date column for each table, the most frequently used lookup.
+DATE_COL = {k: v.date_col for k, v in sharadar_tables.items()}
+
+# Query for whether a table has been created in the database.
+TABLE_EXISTS_SQL = "SELECT name FROM sqlite_master WHERE type = 'table' AND tbl_name = ?"
+
+# Query for the latest date saved in each table, built once.
+LAST_DATE_SQL = {
+    k: "SELECT {0} FROM {1} ORDER BY {0} DESC LIMIT 1".format(v, k)
+    for k, v in DATE_COL.items()
+}
+
+# Queries reading and recording the latest date of a table in _meta.
+META_DATE_SQL = "SELECT max_date FROM _meta WHERE table_name = ?"
+SAVE_META_DATE_SQL = {
+    k: "INSERT OR REPLACE INTO _meta VALUES (?, ({}))".format(v) for k, v in LAST_DATE_SQL.items()
+}
+
+# Index on the date column of each table.
+INDEX_DATES_SQL = {
+    k: "CREATE INDEX IF NOT EXISTS idx_{0}_{1} ON {0}({1} DESC)".format(k, v)
+    for k, v in DATE_COL.items()
 }
 
 
@@ -53,6 +141,14 @@ def db_exists(args):
         return None
 
 
+def table_exists(table, args):
+    # Check if the table has already been created in the database.
+    conn = get_conn(args)
+    exists = conn.execute(TABLE_EXISTS_SQL, (table,)).fetchone() is not None
+
+    return exists
+
+
 def set_tables(args):
     # Set the tables.
     if args.tables:
@@ -73,20 +169,33 @@ def set_tables(args):
     return tables
 
 
-def get_all_tickers(args):
-    # Get a list of all the tickers in the db.
-    sql = "SELECT DISTINCT ticker FROM tickers"
-    conn = connect(path_save(args))
-    all_tickers = pd.read_sql(sql, con=conn)
-    conn.close()
-    all_tickers = sorted(all_tickers["ticker"].to_list())
+def get_ticker_chunks(args, n=1000):
+    """
+    Returns all the tickers in the database in chunks of n. Built once, by the first table to ask,
+    while any other table asking at the same time waits for it.
+    :param args: See --help in args.parse
+    :param n: Number of tickers in a chunk.
+    :return list: Tuples of tickers, in ticker order.
+    """
+    import pandas as pd
+
+    key = (path_save(args), n)
+    with ticker_chunks_lock:
+        if key not in ticker_chunks_cache:
+            # Get a list of all the tickers in the db.
+            sql = "SELECT DISTINCT ticker FROM tickers"
+            conn = get_conn(args)
+            all_tickers = pd.read_sql(sql, con=conn)
+            all_tickers = sorted(all_tickers["ticker"].to_list())
+            ticker_chunks_cache[key] = [tuple(tc) for tc in chunks(all_tickers, n)]
 
-    return all_tickers
+    return ticker_chunks_cache[key]
 
 
+@functools.lru_cache(maxsize=1)
 def get_today():
-    """Return today's date."""
-    return datetime.date.today().strftime("%Y-%m-%d")
+    """Return today's date, fixed for the rest of the run."""
+    return datetime.date.today().isoformat()
 
 
 def connect(filepath):
@@ -97,34 +206,218 @@ def connect(filepath):
     :return conn: Returns a connection object.
     """
 
-    # Connect to the database.
-    return sqlite3.connect(filepath)
+    # Connect to the database and tune it for bulk appends. Tables are written from several threads,
+    # so wait on another writer's lock rather than failing straight away.
+    conn = sqlite3.connect(filepath, timeout=300, check_same_thread=False)
+    # Larger pages suit these wide, append-only tables. SQLite only applies it to a new database,
+    # before the switch to WAL.
+    conn.execute("PRAGMA page_size=65536")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.execute("PRAGMA mmap_size=268435456")
+
+    # Latest date stored for each table, so an update doesn't have to look it up in the table itself.
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS _meta(table_name TEXT PRIMARY KEY, max_date TEXT)"
+    )
+
+    return conn
 
 
-def get_data(table, kwarg):
+def get_conn(args):
+    """
+    Returns the calling thread's connection to the database, opening it on first use. Each worker
+    keeps one connection for the whole run instead of reconnecting in every helper.
+    :param args: See --help in args.parse
+    :return conn: Returns a connection object.
     """
-    Using the table name and kwargs retrieves the most current data.
+    # Keyed on the arguments rather than path_save, which would make the directory on every call.
+    conns = local_conns.__dict__.setdefault("conns", {})
+    key = (args.directory, args.save_name)
+    if key not in conns:
+        conns[key] = connect(path_save(args))
+        with open_conns_lock:
+            open_conns.append(conns[key])
+
+    return conns[key]
+
+
+def close_conns():
+    """Closes every connection opened by get_conn during the run."""
+    with open_conns_lock:
+        for conn in open_conns:
+            conn.close()
+        open_conns.clear()
+    local_conns.__dict__.clear()
+
+
+def share_session(pool_size=8):
+    """
+    Makes quandl reuse the module session instead of opening a new connection for every page.
+    :param pool_size: Number of connections kept open to Quandl.
+    :return None:
+    """
+    import quandl
+
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=quandl.connection.Connection.get_retries(),
+    )
+    session.mount("https://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip"})
+    quandl.connection.Connection.get_session = classmethod(lambda cls: session)
+
+
+def get_pages(table, kwarg):
+    """
+    Using the table name and kwargs retrieves the most current data, one Quandl page at a time.
     :param table: Name of table to update.
     :param kwarg: Dictionary containing the parameters to send to Quandl.
-    :return dataframe: Pandas dataframe containing latest data for the table.
+    :return generator: Pandas dataframes, one for each page of the latest data for the table.
+    """
+    from quandl.model.datatable import Datatable
+
+    params = dict(kwarg)
+    while True:
+        with quandl_slots:
+            page = Datatable("SHARADAR/" + table.upper()).data(params=copy.deepcopy(params))
+        yield page.to_pandas()
+
+        cursor_id = page.meta["next_cursor_id"]
+        if cursor_id is None:
+            break
+        params["qopts.cursor_id"] = cursor_id
+
+
+def request_export(table):
+    """
+    Asks Quandl for the bulk export of a table, which starts building the file if it isn't ready.
+    :param table: Name of table to export.
+    :return dict: Export file information, with its `status` and download `link`.
+    """
+    import quandl
+    from quandl.errors.quandl_error import QuandlError
+
+    params = {"qopts.export": "true", "api_key": quandl.ApiConfig.api_key}
+    with quandl_slots:
+        r = session.get(bulk_url.format(table.upper()), params=params, timeout=http_timeout)
+    r.raise_for_status()
+
+    try:
+        file_info = r.json()["datatable_bulk_download"]["file"]
+        return {"status": file_info["status"], "link": file_info.get("link")}
+    except (KeyError, TypeError, ValueError):
+        raise QuandlError("Unexpected bulk export response for table {}.".format(table))
+
+
+def get_bulk_file(table, wait=30, checks=120):
+    """
+    Downloads the bulk export of a whole table to a temporary file instead of paginating.
+    :param table: Name of table to download.
+    :param wait: Seconds to wait between checks while Quandl generates the export file.
+    :param checks: Number of times to check for the export file before giving up.
+    :return str: Path of the zipped CSV. The caller removes it.
     """
-    return quandl.get_table("SHARADAR/" + table.upper(), paginate=True, **kwarg)
+    from quandl.errors.quandl_error import QuandlError
+
+    # Quandl builds the export file on request, poll until it is ready.
+    file_info = request_export(table)
+    for _ in range(checks):
+        if file_info["status"] == "fresh":
+            break
+        time.sleep(wait)
+        file_info = request_export(table)
+    if file_info["status"] != "fresh":
+        raise QuandlError("The bulk export of {} was not ready in time.".format(table))
+
+    # Write the file to disk as it arrives, tables like SEP are several GB.
+    f = tempfile.NamedTemporaryFile(suffix=".zip", delete=False)
+    try:
+        with f, quandl_slots:
+            with session.get(file_info["link"], stream=True, timeout=http_timeout) as r:
+                r.raise_for_status()
+                for block in r.iter_content(chunk_size=1 << 20):
+                    f.write(block)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+    return f.name
+
+
+def read_bulk_file(f, table, chunksize=100_000):
+    """
+    Reads a bulk export file in blocks. The export is a plain CSV, so every column holding only
+    dates is parsed here, the way the API pages parse their Date columns. Otherwise those dates
+    would be saved in a different format and no longer match the same rows from the API when
+    upserting.
+    :param f: Path or file object of the zipped CSV.
+    :param table: Name of the exported table.
+    :param chunksize: Number of rows in each block.
+    :return generator: Pandas dataframes, one for each block of rows.
+    """
+    import pandas as pd
+
+    reader = pd.read_csv(f, compression="zip", parse_dates=[DATE_COL[table]], chunksize=chunksize)
+    try:
+        for df in reader:
+            for c in df.select_dtypes(include=["object", "string"]).columns:
+                values = df[c].dropna().astype(str)
+                if len(values) > 0 and values.str.match(r"\d{4}-\d{2}-\d{2}$").all():
+                    df[c] = pd.to_datetime(df[c], format="%Y-%m-%d")
+            yield df
+    finally:
+        reader.close()
+
+
+def bulk_pages(table, date_end):
+    """
+    Retrieves the whole table with the bulk export, up to the end date, in blocks of rows.
+    :param table: Name of table to download.
+    :param date_end: Last date to keep.
+    :return generator: Pandas dataframes, one for each block of the table.
+    """
+    path = get_bulk_file(table)
+    try:
+        for df in read_bulk_file(path, table):
+            yield df[df[DATE_COL[table]] <= date_end]
+    finally:
+        os.remove(path)
 
 
 def init_dates(table, args):
 
-    date_col = sharadar_tables[table][0]
+    date_col = DATE_COL[table]
+    todate = args.todate
 
     # Get ending date.
-    if args.todate:
-        date_end = args.todate
+    if todate:
+        date_end = todate
     else:
-        date_end = pd.to_datetime(get_today()) - pd.Timedelta("1 days")
-        date_end = date_end.strftime("%Y-%m-%d")
+        date_end = datetime.date.fromisoformat(get_today()) - datetime.timedelta(days=1)
+        date_end = date_end.isoformat()
 
     return date_col, date_end
 
 
+def has_weekday(date_start, date_end):
+    """
+    Checks if any day from start to end, inclusive, falls on a weekday.
+    :param date_start: First date as YYYY-MM-DD.
+    :param date_end: Last date as YYYY-MM-DD.
+    :return bool:
+    """
+    start = datetime.date.fromisoformat(date_start)
+    days = (datetime.date.fromisoformat(date_end) - start).days + 1
+
+    return any(
+        (start + datetime.timedelta(days=d)).weekday() < 5 for d in range(min(days, 7))
+    )
+
+
 def path_directory(args):
     """
     Set path and make directory if necessary
@@ -158,82 +451,155 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
-def accumulate_results(df_downloaded, t, args):
-    """ Collect the downloaded tables in a `side` table."""
-
-    # Validate accumulated table and append to original.
-    table_name = t + "_cumm"
-    conn = connect(path_save(args))
-    df_downloaded.to_sql(table_name, con=conn, if_exists="append", index=False)
-    conn.close()
-
+@functools.lru_cache(maxsize=32)
+def insert_sql(table, columns, key=None):
+    """
+    Builds the INSERT statement for a table once, and reuses it for every batch after.
+    :param table: Name of the table to insert into.
+    :param columns: Tuple of the column names being inserted.
+    :param key: Tuple of the columns identifying a row, to update rows already in the table.
+    :return str: SQL statement with one placeholder per column.
+    """
+    columns = ['"{}"'.format(c) for c in columns]
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        table, ",".join(columns), ",".join(["?"] * len(columns))
+    )
+    if key:
+        sql += " ON CONFLICT({}) DO UPDATE SET {}".format(
+            ",".join('"{}"'.format(c) for c in key),
+            ",".join("{0}=excluded.{0}".format(c) for c in columns),
+        )
 
-def consolidate_results(t, tstart, args):
-    # Validate accumulated table and append to original.
-    table_name = t + "_cumm"
-    sql = "SELECT * FROM " + table_name
+    return sql
 
-    conn = connect(path_save(args))
-    try:
-        df_cumm = pd.read_sql(sql, con=conn)
-    except:
-        if args.print_on:
-            print(
-                "There was no downloaded data to add from {} to {}.".format(
-                    table_name, t
-                )
-            )
-        conn.close()
-        return
 
-    if df_cumm.size > 0:
-        df_cumm.to_sql(t, con=conn, if_exists="append", index=False)
-        if args.print_on:
-            print("Completed download of {} in {}".format(t, time.time() - tstart))
+def insert_rows(conn, table, df, key=None):
+    """
+    Appends a dataframe to a table through one prepared INSERT fed to executemany. The rows are
+    not committed, so several calls can share the caller's transaction.
+    :param conn: Database connection.
+    :param table: Name of the table to append to.
+    :param df: Pandas dataframe with the rows to insert.
+    :param key: Columns identifying a row. If given, rows already in the table are updated instead.
+    :return None:
+    """
+    # Let pandas create the table and its column types if it doesn't exist yet. Pandas commits when
+    # it writes, so it is only called for a new table.
+    if conn.execute(TABLE_EXISTS_SQL, (table,)).fetchone() is None:
+        df.head(0).to_sql(table, con=conn, index=False)
+
+    # Dates are stored as text, the same way pandas writes them.
+    dates = df.select_dtypes("datetime").columns
+    df = df.assign(**{c: df[c].dt.strftime("%Y-%m-%d %H:%M:%S") for c in dates})
+
+    # Only upsert when every key column is there. SQLite reads an unknown quoted name as a string,
+    # which would make every row collide.
+    if key and set(key) <= set(df.columns):
+        try:
+            index_key(conn, table, key)
+        except sqlite3.IntegrityError:
+            # Tables saved before the key was enforced can hold duplicates, keep appending to those.
+            key = None
     else:
-        if args.print_on:
-            print("No data to add to {}".format(t))
+        key = None
 
-    c = conn.cursor()
-    sql = "DROP TABLE {}".format(table_name)
-    c.execute(sql)
-    conn.close()
+    sql = insert_sql(table, tuple(df.columns), key and tuple(key))
+    conn.executemany(sql, df.itertuples(index=False, name=None))
 
 
-def download_table(table, args, tc=None):
+def index_key(conn, table, key):
     """
-    Saves Quandl data to local sqlite3 database.
-    :param table: Table to be downloaded from Quandl.
-    :param args: See --help in args.parse
+    Creates the unique index on the key of a table, which the upsert in insert_rows relies on.
+    :param conn: Database connection.
+    :param table: Name of the table to index.
+    :param key: Columns identifying a row.
     :return None:
     """
+    sql = "CREATE UNIQUE INDEX IF NOT EXISTS uq_{0} ON {0}({1})".format(
+        table, ",".join('"{}"'.format(c) for c in key)
+    )
+    conn.execute(sql)
 
-    date_col, date_end = init_dates(table, args)
 
-    # Get filepath.
-    file_path = path_save(args)
+def dedupe_key(conn, table):
+    """
+    Indexes the key of a table that already holds rows: one just loaded from the bulk export, where
+    the index is built once rather than kept up to date during the load, or one saved before the
+    key was enforced. Rows repeated in the table are first reduced to the last copy, as the upsert
+    would have done.
+    :param conn: Database connection.
+    :param table: Name of the table to index.
+    :return None:
+    """
+    key = sharadar_tables[table].key
+    columns = {r[1] for r in conn.execute("PRAGMA table_info({})".format(table))}
+    if not key or not set(key) <= columns:
+        return
 
-    # Check if table exist and get the start date. If table doesn't exist, set start date to one week before end date.
-    sql_check_table_exist = "SELECT name FROM sqlite_master WHERE type = 'table' AND tbl_name = '{}';".format(
-        table
+    sql = "DELETE FROM {0} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {0} GROUP BY {1})".format(
+        table, ",".join('"{}"'.format(c) for c in key)
     )
-    conn = connect(file_path)
-    c = conn.cursor()
-    c.execute(sql_check_table_exist)
-
-    if len(c.fetchall()) == 1:
-        sql = "SELECT MAX({}) FROM {}".format(date_col, table)
-        c.execute(sql)
-        date_start = (
-            pd.to_datetime(c.fetchone()[0]) + pd.Timedelta("1 days")
-        ).strftime("%Y-%m-%d")
+    conn.execute(sql)
+    index_key(conn, table, key)
+
+
+def index_dates(conn, table):
+    """
+    Indexes the date column of a table so the latest date lookup doesn't scan the table.
+    :param conn: Database connection.
+    :param table: Name of the table to index.
+    :return None:
+    """
+    conn.execute(INDEX_DATES_SQL[table])
+
+
+def get_date_start(conn, table, args, date_end, bulk=False):
+    """
+    Finds the first date to download for a table, the day after the latest date saved. A table that
+    is new or empty starts one week before the end date, or is downloaded whole in bulk.
+    :param conn: Database connection.
+    :param table: Name of the table.
+    :param args: See --help in args.parse
+    :param date_end: Last date to download.
+    :param bulk: True to download a new or empty table whole with the bulk export.
+    :return str: Start date as YYYY-MM-DD, None if the table is downloaded in bulk.
+    """
+    last_date = None
+    if table_exists(table, args):
+        row = conn.execute(META_DATE_SQL, (table,)).fetchone()
+        if row is None:
+            # Tables saved before _meta existed are brought up to date here, before their first
+            # lookup. Those updates saved every row twice, and the copies would keep the key index
+            # from being created, so they are dropped once.
+            with db_write_lock, conn:
+                dedupe_key(conn, table)
+                index_dates(conn, table)
+            row = conn.execute(LAST_DATE_SQL[table]).fetchone()
+        # An empty table has no last date, and is started the same way as a new one.
+        last_date = row[0] if row else None
+
+    if last_date:
+        date_start = datetime.date.fromisoformat(last_date[:10]) + datetime.timedelta(days=1)
+    elif bulk:
+        return None
     else:
-        date_start = pd.to_datetime(date_end) - pd.Timedelta("7 days")
-        date_start = date_start.strftime("%Y-%m-%d")
+        date_start = datetime.date.fromisoformat(date_end) - datetime.timedelta(days=7)
         if args.print_on:
             print(date_start)
 
-    conn.close()
+    return date_start.isoformat()
+
+
+def table_pages(table, date_start, date_end, tc=None):
+    """
+    Sets up the download of a table from Quandl between two dates.
+    :param table: Table to be downloaded from Quandl.
+    :param date_start: First date to download, None to download the whole table in bulk.
+    :param date_end: Last date to download.
+    :param tc: Tickers to restrict the download to.
+    :return generator: Pandas dataframes, one for each page of data.
+    """
+    date_col = DATE_COL[table]
 
     # Get the data between the dates from Quandl and restricted for tickers if tc not null.
     if tc and len(tc) != 0:
@@ -241,57 +607,209 @@ def download_table(table, args, tc=None):
     else:
         kwarg = {date_col: {"gte": date_start, "lte": date_end}}
 
+    if date_start is None:
+        return bulk_pages(table, date_end)
+    else:
+        return get_pages(table, kwarg)
+
+
+def save_chunk(table, args, date_start, date_end, tc):
+    """
+    Downloads one chunk of tickers and saves its pages as they arrive, on the calling thread's own
+    connection.
+    :param table: Table to be downloaded from Quandl.
+    :param args: See --help in args.parse
+    :param date_start: First date to download.
+    :param date_end: Last date to download.
+    :param tc: Tickers to restrict the download to.
+    :return int: Number of rows saved, None if the data could not be retrieved from Quandl.
+    """
+    pages = table_pages(table, date_start, date_end, tc=tc)
+    return download_table(get_conn(args), table, args, pages, tc=tc)
+
+
+def save_chunks(table, args, date_start, date_end, ticker_chunks):
+    """
+    Downloads and saves chunks of tickers in parallel, chunk_workers at a time. A chunk is only
+    started once an earlier one has been taken, so progress is reported in chunk order.
+    :param table: Table to be downloaded from Quandl.
+    :param args: See --help in args.parse
+    :param date_start: First date to download.
+    :param date_end: Last date to download.
+    :param ticker_chunks: Chunks of tickers to restrict each download to.
+    :return generator: Tuples of the tickers and their rows saved, see save_chunk, in chunk order.
+    """
+    with ThreadPoolExecutor(max_workers=chunk_workers) as ex:
+        pending = deque()
+        for tc in ticker_chunks:
+            pending.append((tc, ex.submit(save_chunk, table, args, date_start, date_end, tc)))
+            if len(pending) == chunk_workers:
+                tc_done, future = pending.popleft()
+                yield tc_done, future.result()
+        while pending:
+            tc_done, future = pending.popleft()
+            yield tc_done, future.result()
+
+
+def download_table(conn, table, args, pages, tc=None, bulk=False):
+    """
+    Saves Quandl data to local sqlite3 database.
+    :param conn: Database connection.
+    :param table: Table to be downloaded from Quandl.
+    :param args: See --help in args.parse
+    :param pages: Pandas dataframes from Quandl, see table_pages.
+    :param tc: Tickers the download was restricted to.
+    :param bulk: True for a new table loaded from the bulk export, its key is indexed afterwards.
+    :return int: Number of rows saved, None if the data could not be retrieved from Quandl.
+    """
+    import numpy as np
+    import pandas as pd
+    from quandl.errors.quandl_error import QuandlError
+
+    date_col = DATE_COL[table]
+    print_on = args.print_on
+    key = None if bulk else sharadar_tables[table].key
+
+    # Save each page in its own transaction as it arrives, so the write lock is only held for the
+    # insert and not while waiting on Quandl for the next page. Rows downloaded again replace the
+    # saved ones through the table's key, so in a keyed table an update that fails part way is
+    # repaired by the next one.
+    rows = 0
     try:
-        df_new = get_data(table, kwarg)
-    except:
-        return 1
+        for df_new in pages:
+            if df_new.empty:
+                continue
+            with db_write_lock, conn:
+                insert_rows(conn, table, df_new, key=key)
+
+            if print_on:
+                # The frame is unsorted, take the date range straight from the numpy values.
+                dates = df_new[date_col].values
+                print(
+                    "Saved table {} date from {} to {}, ticker from {} to {}.".format(
+                        table,
+                        np.datetime_as_string(np.min(dates), unit="D"),
+                        np.datetime_as_string(np.max(dates), unit="D"),
+                        df_new["ticker"].min(),
+                        df_new["ticker"].max(),
+                    )
+                )
+
+            if args.print_rows != 0 and rows == 0:
+                if print_on:
+                    print(
+                        "Table: {}, shape {} \n{}".format(
+                            table,
+                            df_new.shape,
+                            df_new.head(pd.to_numeric(args.print_rows)),
+                        )
+                    )
+                else:
+                    pass
+
+            rows += len(df_new)
+    except (
+        QuandlError,
+        requests.RequestException,
+        zipfile.BadZipFile,
+        pd.errors.EmptyDataError,
+        pd.errors.ParserError,
+    ):
+        return None
 
-    if df_new.size == 0:
+    if rows == 0:
         if tc:
-            if args.print_on:
+            if print_on:
                 print(
                     "No data retrieved for table {} from {} to {}".format(
                         table, tc[0], tc[-1]
                     )
                 )
         else:
-            if args.print_on:
+            if print_on:
                 print("No data retrieved for table {}".format(table))
-        return df_new
-
-    if table == "SF3B":
-        df_new = df_new.sort_values(date_col, ascending=False)
-    else:
-        df_new = df_new.sort_values([date_col, "ticker"], ascending=[False, True])
 
-    # Join the new data from Quandl with the existing dataframe and sort, reset index.
-    table_name = table + "_cumm"
-    conn = connect(file_path)
-    df_new.to_sql(table_name, con=conn, if_exists="append", index=False)
-    conn.close()
+    return rows
 
-    if args.print_on:
-        print(
-            "Saved table {} date from {} to {}, ticker from {} to {}.".format(
-                table,
-                df_new[date_col].min().strftime("%Y-%m-%d"),
-                df_new[date_col].max().strftime("%Y-%m-%d"),
-                df_new["ticker"].min(),
-                df_new["ticker"].max(),
-            )
-        )
 
-    if args.print_rows != 0 and df_new.shape[0] != 0:
+def sync_table(t, args):
+    """
+    Downloads the new data for one table and appends it to the database.
+    :param t: Table to be updated.
+    :param args: See --help in args.parse
+    :return None:
+    """
+    tstart = time.time()
+    conn = get_conn(args)
+    date_col, date_end = init_dates(t, args)
+
+    # Set the dates once for the whole table, as chunks saved early would otherwise move the start
+    # date for the chunks after them. Tables with no rows yet are downloaded whole when using bulk,
+    # including one left empty by a bulk load that failed part way.
+    date_start = get_date_start(conn, t, args, date_end, args.bulk)
+    bulk = date_start is None
+
+    # Tables keyed on the trading date have nothing new when the range holds no weekday, e.g. a run
+    # on a Sunday after Friday's data was saved. Skip the request to Quandl.
+    if date_start is not None and date_col == "date" and not has_weekday(date_start, date_end):
         if args.print_on:
-            print(
-                "Table: {}, shape {} \n{}".format(
-                    table, df_new.shape, df_new.head(pd.to_numeric(args.print_rows))
-                )
-            )
-        else:
-            pass
+            print("No trading days for table {} from {} to {}".format(t, date_start, date_end))
+        return
 
-    return df_new
+    # Check if table is a large table (>1), if so, break into chunks by ticker. A week or less of
+    # data is small enough to page through whole, in far fewer requests than one per chunk.
+    short = date_start is not None and (
+        datetime.date.fromisoformat(date_end) - datetime.date.fromisoformat(date_start)
+    ).days <= 7
+    rows = 0
+    if sharadar_tables[t].size > 1 and not bulk and not short:
+        # Get tickers in chunks of 1000. The chunks are downloaded and saved in parallel, each page
+        # taking the write lock only for its insert.
+        ticker_chunks = get_ticker_chunks(args, 1000)
+        for tc, rows_saved in save_chunks(t, args, date_start, date_end, ticker_chunks):
+            if args.print_on:
+                print(
+                    "\nDownloading stocks in {} from {} to {}".format(
+                        t, tc[0], tc[-1]
+                    )
+                )
+            if rows_saved is None:
+                if args.print_on:
+                    print(
+                        "There was an error connecting to quandl for stocks in {} from {} to {}".format(
+                            t, tc[0], tc[-1]
+                        )
+                    )
+                continue
+            rows += rows_saved
+    else:
+        # For smaller tables, download the whole table at once. A bulk export is saved to a file
+        # before its first block is read.
+        pages = table_pages(t, date_start, date_end)
+        rows_saved = download_table(conn, t, args, pages, bulk=bulk)
+        if rows_saved is None:
+            if bulk:
+                # The blocks are committed as they are read, drop the part loaded so the next run
+                # loads the table in bulk again.
+                with db_write_lock, conn:
+                    conn.execute("DROP TABLE IF EXISTS {}".format(t))
+            if args.print_on:
+                print("There was an error connecting to quandl for stocks in {}".format(t))
+            return
+        rows = rows_saved
+
+    if rows > 0:
+        # Index the dates once the rows are in, then record the latest date for the next update.
+        with db_write_lock, conn:
+            if bulk:
+                dedupe_key(conn, t)
+            index_dates(conn, t)
+            conn.execute(SAVE_META_DATE_SQL[t], (t,))
+        if args.print_on:
+            print("Completed download of {} in {}".format(t, time.time() - tstart))
+    else:
+        if args.print_on:
+            print("No data to add to {}".format(t))
 
 
 def main(args=None):
@@ -302,6 +820,8 @@ def main(args=None):
     :param args:
     :return None:
     """
+    import quandl
+    from quandl.errors.quandl_error import QuandlError
 
     args = parse_args(args)
     start_timer = time.time()
@@ -309,52 +829,39 @@ def main(args=None):
     # api_key = args.key    ### todo USE THIS LINE IN LIVE VERSION.
     api_key = apikey  ### todo delete this
     quandl.ApiConfig.api_key = api_key
+    # Keep at least one open connection per worker so none of them has to reconnect to Quandl.
+    share_session(pool_size=max(8, args.workers))
 
     tables = set_tables(args)
+    ticker_chunks_cache.clear()
 
     # Check db exists
     db_exists(args)
 
-    tstart = time.time()
-
-    for t in tables:
-        # Check if table is a large table (>1), if so, break into chunks by ticker.
-        if sharadar_tables[t][2] > 1:
-            all_tickers = get_all_tickers(args)
-
-            # Get tickers in chunks of 1000.
-            ticker_chunks = chunks(all_tickers, 1000)
-            for tc in ticker_chunks:
-                if args.print_on:
-                    print(
-                        "\nDownloading stocks in {} from {} to {}".format(
-                            t, tc[0], tc[-1]
-                        )
-                    )
-                df_downloaded = download_table(t, args, tc=tc)
-                if isinstance(df_downloaded, (int, float)) and df_downloaded==1:
-                    if args.print_on:
-                        print(
-                            "There was an error connecting to quandl for stocks in {} from {} to {}".format(
-                                t, tc[0], tc[-1]
-                            )
-                        )
-                    continue
-                elif df_downloaded.size != 0:
-                    accumulate_results(df_downloaded, t, args)
-        else:
-            # For smaller tables, download the whole table at once.
-            df_downloaded = download_table(t, args)
-            if isinstance(df_downloaded, (int, float)) and df_downloaded==1:
-                if args.print_on:
-                    print("There was an error connecting to quandl for stocks in {}".format(t))
-                continue
-            elif df_downloaded.size != 0:
-                accumulate_results(df_downloaded, t, args)
+    # Start every bulk export up front so Quandl builds the files at the same time rather than
+    # one table after another as the workers reach them. This is only a head start, a table whose
+    # request fails asks again when it is downloaded.
+    if args.bulk:
+        for t in tables:
+            if not table_exists(t, args):
+                try:
+                    request_export(t)
+                except (QuandlError, requests.RequestException):
+                    pass
+
+    # Tables are independent, so download them concurrently while each waits on Quandl. TICKERS is
+    # updated first, so the tables downloaded by ticker use the current list.
+    try:
+        if "TICKERS" in tables:
+            sync_table("TICKERS", args)
+            tables = [t for t in tables if t != "TICKERS"]
 
-        consolidate_results(t, tstart, args)
+        with ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(tables)))) as ex:
+            list(ex.map(lambda t: sync_table(t, args), tables))
 
-        tstart = time.time()
+        get_conn(args).execute("PRAGMA optimize")
+    finally:
+        close_conns()
 
     if args.print_on:
         print("Elapsed time is {:.2f}".format(time.time() - start_timer))
@@ -371,7 +878,7 @@ def add_bool_arg(parser, name, default=False, help_text=""):
 
 
 # noinspection PyTypeChecker
-def parse_args(pargs=None):
+def _build_parser():
     parser = argparse.ArgumentParser(
         # formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         formatter_class=argparse.RawTextHelpFormatter,
@@ -413,6 +920,14 @@ def parse_args(pargs=None):
         parser, "print_on", False, "Print output. --print_on True; --no-print_on False"
     )
 
+    add_bool_arg(
+        parser,
+        "bulk",
+        False,
+        "Download tables not yet in the database in full using Quandl's bulk export. \n"
+        "--bulk True; --no-bulk False",
+    )
+
     parser.add_argument(
         "--print_rows",
         required=False,
@@ -421,11 +936,27 @@ def parse_args(pargs=None):
         "Accepts integer as number of rows to display.",
     )
 
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=5,
+        help="Number of tables to download at the same time.",
+    )
+
     parser.add_argument(
         "--key", required=False, default="your_api_key", help="Quandl API key.",
     )  # todo remove apikey
 
-    return parser.parse_args(pargs)
+    return parser
+
+
+# The parser is built once at import and reused for every call.
+_PARSER = _build_parser()
+
+
+def parse_args(pargs=None):
+    return _PARSER.parse_args(pargs)
 
 
 if __name__ == "__main__":